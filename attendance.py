@@ -1,55 +1,127 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 import sqlite3
+import threading
 import time
-from flask import Flask, request, g
+from flask import Flask, Response, request
 
 # ------------------------------------------------
 # LOGGING CONFIGURATION
 # ------------------------------------------------
-# Configure logging to display timestamps and log levels.
+# Log records are pushed onto an unbounded queue and written out by a
+# QueueListener on a background thread, so request threads never block
+# on stderr while handling a batch of punches.
 # In a real production environment, you might log to a file or an external aggregator.
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+_log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logging.root.setLevel(logging.INFO)
+logging.root.addHandler(logging.handlers.QueueHandler(_log_queue))
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 DB_FILE = 'attendance.db'
 
+# Pre-built response for every trivial "OK" answer. Built once from
+# bytes with the Content-Length already set, so the highest-QPS paths
+# (/iclock/getrequest polls, acknowledgements for unprocessed tables)
+# skip Response construction, encoding and header computation entirely.
+# direct_passthrough hands the body straight to the WSGI layer.
+_OK_RESP = Response(b"OK", status=200, mimetype="text/plain", direct_passthrough=True)
+_OK_RESP.headers["Content-Length"] = "2"
+
+# Handshake response rendered once; only the device serial and OpStamp
+# change per request, so a single %-substitution replaces building and
+# joining the ten option lines every time.
+# Parameters:
+#   Stamp: Last synchronization stamp
+#   OpStamp: Operation stamp
+#   ErrorDelay: Retry delay in minutes if error
+#   Delay: Polling interval in seconds
+#   TransTimes: Transmission times
+#   TransInterval: Transmission interval
+#   TransFlag: Binary flags for data transmission
+#   Realtime: Enable realtime transmission
+_HANDSHAKE_TMPL = (
+    "GET OPTION FROM: %s\n"
+    "Stamp=9999\n"
+    "OpStamp=%d\n"
+    "ErrorDelay=30\n"
+    "Delay=10\n"
+    "TransTimes=00:00;23:59\n"
+    "TransInterval=1\n"
+    "TransFlag=1111000000\n"
+    "Realtime=1\n"
+    "Encrypt=None"
+).encode()
+
 # ------------------------------------------------
 # DATABASE HANDLING
 # ------------------------------------------------
-def get_db():
-    """
-    Opens a new database connection if there is none yet for the current application context.
-    Using Flask's 'g' object to store the connection per request.
-    """
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DB_FILE)
-        # Return rows as dictionaries/accessible by name for better readability
-        db.row_factory = sqlite3.Row
-    return db
+# Single module-level SQL string for punch inserts. Passing the same
+# literal object to executemany() every time guarantees a hit in the
+# connection's statement cache, so SQLite never re-parses the query.
+# OR IGNORE + the unique index created in bootstrap() make inserts
+# idempotent: devices resend ATTLOG batches after network errors, and
+# duplicates are dropped inside SQLite's B-tree instead of piling up.
+_INSERT_ATTLOG = (
+    "INSERT OR IGNORE INTO attendance_logs (user_id, punch_time, device_serial, is_synced) "
+    "VALUES (?, ?, ?, ?)"
+)
 
-@app.teardown_appcontext
-def close_connection(exception):
+def _new_connection():
     """
-    Closes the database connection at the end of the request.
-    This is automatically called by Flask.
+    Creates a fully configured SQLite connection for the writer.
     """
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    # check_same_thread=False lets the connection be handed between
+    # threads (the writer is created at import time and then used by the
+    # flusher, maintenance and atexit threads). cached_statements keeps
+    # compiled queries around so repeated inserts skip the SQL parser,
+    # and isolation_level=None disables the implicit-transaction
+    # machinery in favour of explicit BEGIN/COMMIT below.
+    db = sqlite3.connect(
+        DB_FILE,
+        check_same_thread=False,
+        cached_statements=256,
+        isolation_level=None,
+    )
+    # Return rows as dictionaries/accessible by name for better readability
+    db.row_factory = sqlite3.Row
+    # Tune the connection for a write-heavy workload:
+    #   WAL avoids the rollback-journal double write and lets readers
+    #   run while a commit is in flight; synchronous=NORMAL drops the
+    #   extra fsync per commit (safe with WAL); the rest keeps temp
+    #   data and hot pages in memory instead of on disk.
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-20000")   # ~20 MB page cache
+    db.execute("PRAGMA mmap_size=268435456")  # 256 MB mmap window
+    # Raise the autocheckpoint threshold (default 1000 pages) so flusher
+    # transactions don't stall on a checkpoint; the maintenance thread
+    # checkpoints explicitly instead.
+    db.execute("PRAGMA wal_autocheckpoint=10000")
+    return db
 
-def init_db():
+def bootstrap():
     """
-    Initializes the database with the required table(s).
-    This should be run once when the application starts.
+    Creates the database schema. Runs on a throwaway connection, once
+    per process start (from __main__ or the gunicorn post_fork hook),
+    rather than at import time, so forked workers never inherit or race
+    on a connection that predates the fork.
     """
-    with app.app_context():
-        db = get_db()
+    db = sqlite3.connect(DB_FILE)
+    try:
         cursor = db.cursor()
+        # journal_mode persists in the database file, so setting it here
+        # covers every later connection as well.
+        cursor.execute("PRAGMA journal_mode=WAL")
         # Create attendance_logs table if it doesn't exist
         # Columns:
         #   id: Primary key
@@ -68,11 +140,165 @@ def init_db():
                 received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        # A punch is uniquely identified by (device, user, time); the
+        # unique index lets INSERT OR IGNORE drop resent duplicates.
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_att
+            ON attendance_logs (device_serial, user_id, punch_time)
+        ''')
         db.commit()
-        logger.info(f"Database initialized and connected to {DB_FILE}")
+        logger.info("Database initialized and connected to %s", DB_FILE)
+    finally:
+        db.close()
 
-# Initialize the DB structure immediately
-init_db()
+# ------------------------------------------------
+# ATTLOG PARSING
+# ------------------------------------------------
+def _iter_rows(raw, device_sn):
+    """
+    Yields (user_id, punch_time, device_serial, is_synced) tuples from a
+    raw ATTLOG body. Scans the buffer once with find() instead of
+    split()-ing it into intermediate line/field lists; only the two
+    fields we keep are ever decoded or sliced out.
+    Expected line format: UserID \\t Time \\t ...
+    """
+    n = len(raw)
+    i = 0
+    while i < n:
+        nl = raw.find(b"\n", i)
+        if nl < 0:
+            nl = n
+        end = nl
+        # Drop a trailing \r so CRLF bodies parse the same as LF ones.
+        if end > i and raw[end - 1] == 0x0D:
+            end -= 1
+        if end > i:
+            tab = raw.find(b"\t", i, end)
+            if tab < 0:
+                logger.warning("Skipping malformed line: %r", raw[i:end])
+            else:
+                # The punch time runs to the next tab, or to end of line
+                # for two-field records.
+                tab2 = raw.find(b"\t", tab + 1, end)
+                if tab2 < 0:
+                    tab2 = end
+                yield (raw[i:tab].decode("ascii", "replace"),
+                       raw[tab + 1:tab2].decode("ascii", "replace"),
+                       device_sn, 0)
+        i = nl + 1
+
+# ------------------------------------------------
+# WRITE MICRO-BATCHING
+# ------------------------------------------------
+# Parsed rows are queued and committed by a background flusher thread,
+# so a burst of small ATTLOG POSTs shares one BEGIN/COMMIT fsync instead
+# of each request paying its own. The flusher commits whenever it has
+# BATCH_SIZE rows or BATCH_MS has elapsed since the first queued row.
+BATCH_SIZE = 200
+BATCH_MS = 50
+
+_row_queue = queue.SimpleQueue()
+# Dedicated writer connection for the flusher and maintenance threads.
+# The lock serializes them against each other and the atexit drain.
+# Deliberately NOT opened with locking_mode=EXCLUSIVE: the documented
+# deployment runs two gunicorn workers (two writers on the same file)
+# and bootstrap() opens its own DDL connection after import, both of
+# which an engaged exclusive lock would block (see README).
+_writer = _new_connection()
+_writer_lock = threading.Lock()
+
+def _write_batch(rows):
+    """
+    Writes one batch of parsed rows in a single transaction on the
+    dedicated writer connection. Caller must hold _writer_lock.
+    """
+    cursor = _writer.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.executemany(_INSERT_ATTLOG, rows)
+        # rowcount excludes rows the unique index rejected as
+        # duplicates, so this is the true accepted count.
+        count = cursor.rowcount
+        cursor.execute("COMMIT")
+    except Exception:
+        try:
+            cursor.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass  # BEGIN itself failed; nothing to roll back
+        raise
+    logger.info("ATTLOG: flushed %d records to database (%d duplicates ignored)",
+                count, len(rows) - count)
+
+def _flush_rows(rows):
+    """
+    Flushes one batch, logging (rather than raising) database errors so
+    the flusher loop keeps running.
+    """
+    if not rows:
+        return
+    with _writer_lock:
+        try:
+            _write_batch(rows)
+        except sqlite3.Error as e:
+            logger.error("Database error while flushing punches: %s", e)
+
+def _flush_loop():
+    """
+    Daemon loop: blocks for the first queued row, then drains up to
+    BATCH_SIZE rows or until BATCH_MS has passed, and commits the batch.
+    """
+    while True:
+        rows = [_row_queue.get()]
+        deadline = time.monotonic() + BATCH_MS / 1000.0
+        while len(rows) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(_row_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_rows(rows)
+
+threading.Thread(target=_flush_loop, name="attlog-flusher", daemon=True).start()
+
+def _drain_on_exit():
+    """
+    Flushes whatever is still queued before the process exits, so rows
+    acknowledged to a device are not lost on shutdown.
+    """
+    rows = []
+    while True:
+        try:
+            rows.append(_row_queue.get_nowait())
+        except queue.Empty:
+            break
+    _flush_rows(rows)
+
+atexit.register(_drain_on_exit)
+
+# ------------------------------------------------
+# DATABASE MAINTENANCE
+# ------------------------------------------------
+# Interval between WAL checkpoints run off the request path, in seconds.
+MAINTENANCE_INTERVAL = 300
+
+def _maintenance_loop():
+    """
+    Daemon loop: periodically truncates the WAL and refreshes planner
+    statistics on the writer connection, so the checkpoint fsyncs never
+    land on a thread that is serving a device.
+    """
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        with _writer_lock:
+            try:
+                _writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                _writer.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logger.warning("Database maintenance failed: %s", e)
+
+threading.Thread(target=_maintenance_loop, name="db-maintenance", daemon=True).start()
 
 # ------------------------------------------------
 # 1) HANDSHAKE & DATA ENDPOINT: /iclock/cdata
@@ -82,102 +308,61 @@ def cdata():
     """
     Handles both the initial handshake (GET) and data uploads (POST) from the device.
     """
-    args = request.args.to_dict()
-    raw_body = request.get_data(as_text=True)
-    device_sn = args.get("SN", "UNKNOWN")
+    # Read the few known keys straight off the MultiDict; to_dict()
+    # would copy every query parameter on every request.
+    device_sn = request.args.get("SN", "UNKNOWN")
 
     # Logging received request details for debugging
-    # logger.debug(f"/iclock/cdata request from {device_sn} | Method: {request.method}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("/iclock/cdata request from %s | Method: %s | Args: %s",
+                     device_sn, request.method, request.args.to_dict())
 
     # --- Handshake Request (GET) ---
     # The device sends a GET request with options='all' to sync usage parameters.
-    if request.method == "GET" and args.get("options") == "all":
-        logger.info(f"Handshake received from Device: {device_sn}")
-        now = int(time.time())
-
-        # Response parameters:
-        # Stamp: Last synchronization stamp
-        # OpStamp: Operation stamp
-        # ErrorDelay: Retry delay in minutes if error
-        # Delay: Polling interval in seconds
-        # TransTimes: Transmission times
-        # TransInterval: Transmission interval
-        # TransFlag: Binary flags for data transmission
-        # Realtime: Enable realtime transmission
-        resp_lines = [
-            f"GET OPTION FROM: {device_sn}",
-            "Stamp=9999",
-            f"OpStamp={now}",
-            "ErrorDelay=30",
-            "Delay=10",
-            "TransTimes=00:00;23:59",
-            "TransInterval=1",
-            "TransFlag=1111000000",
-            "Realtime=1",
-            "Encrypt=None",
-        ]
-        return "\n".join(resp_lines)
+    if request.method == "GET" and request.args.get("options") == "all":
+        logger.info("Handshake received from Device: %s", device_sn)
+        # Substitute the serial and current OpStamp into the pre-rendered
+        # template (see _HANDSHAKE_TMPL for the parameter meanings).
+        body = _HANDSHAKE_TMPL % (device_sn.encode(), int(time.time()))
+        return Response(body, mimetype="text/plain")
 
     # --- Data Upload (POST) ---
-    table = (args.get("table") or "").upper()
+    table = (request.args.get("table") or "").upper()
     
     # Case: Attendance Logs (ATTLOG)
     if request.method == "POST" and table == "ATTLOG":
-        # Extract non-empty lines from the body
-        lines = [ln.strip() for ln in raw_body.splitlines() if ln.strip()]
-        
-        if not lines:
+        # Read the body as raw bytes; _iter_rows() decodes only the
+        # fields that are actually stored.
+        raw_body = request.get_data(cache=False)
+        # %r is formatted lazily, so the body is only repr()'d when
+        # debug logging is actually enabled.
+        logger.debug("RAW BODY: %r", raw_body)
+
+        if not raw_body.strip():
             logger.warning("ATTLOG received but contains no records.")
-            return "OK: 0"
+            return Response(b"OK: 0", mimetype="text/plain", direct_passthrough=True)
 
-        logger.info(f"Processing ATTLOG batch: {len(lines)} records from Device: {device_sn}")
-        
+        # Hand the parsed rows to the background flusher and acknowledge
+        # immediately; the flusher coalesces rows from multiple POSTs
+        # into one transaction, so this request never waits on an fsync.
         count = 0
-        db = get_db()
-        cursor = db.cursor()
-        
-        try:
-            for line in lines:
-                parts = line.split("\t")
-                # Expected format: UserID \t Time \t ...
-                if len(parts) >= 2:
-                    user_id = parts[0]
-                    punch_time = parts[1]
-                    
-                    # Insert record into SQLite database
-                    cursor.execute('''
-                        INSERT INTO attendance_logs (user_id, punch_time, device_serial, is_synced)
-                        VALUES (?, ?, ?, ?)
-                    ''', (user_id, punch_time, device_sn, 0))
-                    
-                    count += 1
-                else:
-                    logger.warning(f"Skipping malformed line: {line}")
-            
-            db.commit()
-            logger.info(f"Successfully saved {count} attendance records.")
-            
-        except sqlite3.Error as e:
-            db.rollback()
-            logger.error(f"Database error while saving punches: {e}")
-            # In case of DB error, we might want to return 'OK: 0' so device resends later? 
-            # Or just 'OK: 0' to indicate 0 accepted.
-            return "OK: 0"
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Unexpected error: {e}")
-            return "OK: 0"
-
-        # Return the count of successfully processed records to the device
-        return f"OK: {count}"
+        for row in _iter_rows(raw_body, device_sn):
+            _row_queue.put_nowait(row)
+            count += 1
+
+        logger.info("ATTLOG: queued %d records from %s", count, device_sn)
+
+        # Return the count of successfully parsed records to the device.
+        # Built from bytes so Werkzeug skips the str-encoding step.
+        return Response(b"OK: %d" % count, mimetype="text/plain", direct_passthrough=True)
 
     # Case: Other tables (OPERLOG, BIODATA, etc.)
     # We acknowledge them but don't process the data currently.
     if request.method == "POST":
-        logger.info(f"Received data for table '{table}' - Acknowledging without processing.")
-        return "OK"
+        logger.info("Received data for table '%s' - Acknowledging without processing.", table)
+        return _OK_RESP
 
-    return "OK"
+    return _OK_RESP
 
 
 # ------------------------------------------------
@@ -188,16 +373,13 @@ def getrequest():
     """
     Endpoint polled by the device to receive commands from the server.
     """
-    # args = request.args.to_dict()
-    # device_sn = args.get("SN", "UNKNOWN")
-    
-    # If we had commands (e.g. reboot, clear log, user updates), we would return them here.
-    # returning "OK" means "No commands".
-    
+    # If we had commands (e.g. reboot, clear log, user updates), we would
+    # return them here (reading request.args.get("SN") lazily at that
+    # point). The pre-built "OK" means "No commands".
+
     # Logging is disabled here to prevent spamming logs every few seconds.
-    # logger.debug(f"/iclock/getrequest from {device_sn}")
-    
-    return "OK"
+
+    return _OK_RESP
 
 
 # ------------------------------------------------
@@ -208,11 +390,22 @@ def root():
     """
     Fallback route for basic reachability check.
     """
-    return "OK"
+    return _OK_RESP
 
 
+# ------------------------------------------------
+# DEPLOYMENT
+# ------------------------------------------------
+# The single-threaded Werkzeug dev server serializes every request, so
+# the app is served by gunicorn in production (see README.md):
+#
+#     gunicorn -c gunicorn.conf.py attendance:app
+#
+# The config's post_fork hook runs bootstrap() in every worker. Request
+# threads never touch SQLite themselves; all writes go through the
+# single background writer connection (see README's concurrency model).
 if __name__ == "__main__":
-    PORT = 8081
-    logger.info(f"🚀 ZKTeco Push Server running on 0.0.0.0:{PORT}")
-    logger.info("Waiting for attendance punches...")
-    app.run(host="0.0.0.0", port=PORT)
+    bootstrap()
+    logger.info("🚀 ZKTeco Push Server (development mode) on 0.0.0.0:8081")
+    logger.info("Run under gunicorn in production -- see README.md")
+    app.run(host="0.0.0.0", port=8081)
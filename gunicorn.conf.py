@@ -0,0 +1,15 @@
+# Gunicorn configuration for the ZKTeco push server.
+#
+# Do not enable preload_app: the SQLite writer connection and the
+# background threads must be created after the worker fork, which
+# happens naturally when each worker imports the app.
+bind = "0.0.0.0:8081"
+worker_class = "gthread"
+workers = 2
+threads = 8
+
+
+def post_fork(server, worker):
+    """Create the database schema once per worker, after the fork."""
+    from attendance import bootstrap
+    bootstrap()